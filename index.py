@@ -2,12 +2,71 @@ import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
+from email.generator import BytesGenerator
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from gspread.utils import absolute_range_name
+from flask import Flask, request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import atexit
+import hashlib
+import hmac
+import html
+import io
 import json
+import logging
+import logging.handlers
+import operator
 import os
-from datetime import datetime, timedelta
-import pytz
+import queue
+import random
+import re
+import sched
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from string import Template
+from zoneinfo import ZoneInfo
+
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib encoder/decoder
+    orjson = None
+
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(data):
+    """Serialize to compact UTF-8 bytes."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode()
+
+def json_dumps_line(data):
+    """Serialize to one newline-terminated line, as used by the delta logs."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(data, separators=(",", ":")).encode() + b"\n"
+
+
+# Send threads only enqueue log records; a listener thread does the blocking
+# stdout writes, so a slow log pipe never stalls an SMTP worker
+log_queue = queue.SimpleQueue()
+logger = logging.getLogger("workshop")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+log_listener.start()
+atexit.register(log_listener.stop)
 
 
 # =======================
@@ -17,66 +76,307 @@ SENDER_EMAIL = os.getenv("SENDER_EMAIL")
 SENDER_PASSWORD = os.getenv("SENDER_PASSWORD")  # Gmail App Password
 SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
 SMTP_PORT = int(os.getenv("SMTP_PORT", 465))
+SENDER_HEADER = f"Workshop Team Career Lab Consulting <{SENDER_EMAIL}>"
 
 # =======================
 # GOOGLE SHEETS SETUP
 # =======================
-SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+SCOPE = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
 GOOGLE_SERVICE_ACCOUNT_JSON = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
 if not GOOGLE_SERVICE_ACCOUNT_JSON:
     raise ValueError("Environment variable 'GOOGLE_SERVICE_ACCOUNT_JSON' is not set")
 
-creds_dict = json.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
-CREDS = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE)
-CLIENT = gspread.authorize(CREDS)
-
 SHEET_ID = os.getenv("SHEET_ID")
 SHEET_NAME = os.getenv("SHEET_NAME", "New Responses")
-SHEET = CLIENT.open_by_key(SHEET_ID).worksheet(SHEET_NAME)
+
+# Authorizing is a network round-trip, so it happens on first use (a fresh
+# cached run never pays for it) and the client is reused afterwards. The sheet
+# is addressed by key through gspread's HTTP client rather than opened with
+# open_by_key(), which would fetch the whole spreadsheet's metadata first.
+@lru_cache(maxsize=None)
+def get_sheets_http():
+    # google-auth credentials on a keep-alive AuthorizedSession (oauth2client is deprecated)
+    creds_dict = json_loads(GOOGLE_SERVICE_ACCOUNT_JSON)
+    client = gspread.service_account_from_dict(creds_dict, scopes=SCOPE)
+    # Transient API errors and rate limiting are retried on the pooled connection;
+    # once retries run out the last response is returned so gspread raises its
+    # usual APIError instead of a bare requests RetryError
+    client.http_client.session.mount("https://", HTTPAdapter(
+        pool_maxsize=4,
+        max_retries=Retry(
+            total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503], raise_on_status=False
+        ),
+    ))
+    return client.http_client
+
+# Sheet rows are cached on disk so frequent runs don't re-download the sheet
+SHEET_CACHE_TTL = int(os.getenv("SHEET_CACHE_TTL", 300))  # seconds; 0 probes the sheet every run
+SHEET_CACHE_FILE = f".sheet_cache_{hashlib.sha1(f'{SHEET_ID}:{SHEET_NAME}'.encode()).hexdigest()[:12]}.json"
 
 # Persistent tracking files
 PROCESSED_EMAILS_FILE = "processed_emails.json"
 REMINDER_SENT_FILE = "reminder_sent.json"
 WORKSHOP_TRACK_FILE = "workshop_tracking.json"
 
+# Append-only delta logs, folded back into the JSON files at exit
+PROCESSED_LOG_FILE = "processed_emails.jsonl"
+REMINDER_LOG_FILE = "reminder_sent.jsonl"
+
+def upgrade_reminder_keys(keys):
+    """Convert the legacy ["YYYY-MM-DD_HH", ...] list into {date: {hour, ...}}."""
+    slots_by_date = {}
+    for key in keys:
+        date_str, hour = key.rsplit("_", 1)
+        slots_by_date.setdefault(date_str, set()).add(int(hour))
+    return slots_by_date
+
+def read_log(filename):
+    """Yield the entries appended to a delta log since its last compaction."""
+    if not os.path.exists(filename):
+        return
+    with open(filename, "rb") as f:
+        for line in f:
+            try:
+                yield json_loads(line)
+            except json.JSONDecodeError:
+                continue  # blank or half-written line from an interrupted run
+
 if os.path.exists(PROCESSED_EMAILS_FILE):
-    with open(PROCESSED_EMAILS_FILE, "r") as f:
-        processed_emails = set(json.load(f))
+    with open(PROCESSED_EMAILS_FILE, "rb") as f:
+        processed_emails = set(json_loads(f.read()))
 else:
     processed_emails = set()
 
 if os.path.exists(REMINDER_SENT_FILE):
-    with open(REMINDER_SENT_FILE, "r") as f:
-        reminder_sent = json.load(f)
+    with open(REMINDER_SENT_FILE, "rb") as f:
+        reminder_sent = json_loads(f.read())
+    # Reminders are stored as {email: {date: [hour, ...]}} and held with set
+    # values in memory; upgrade older files
+    reminder_sent = {
+        email: upgrade_reminder_keys(slots) if isinstance(slots, list)
+        else {date_str: set(hours) for date_str, hours in slots.items()}
+        for email, slots in reminder_sent.items()
+    }
 else:
     reminder_sent = {}
 
 # Load workshop tracking data
 if os.path.exists(WORKSHOP_TRACK_FILE):
-    with open(WORKSHOP_TRACK_FILE, "r") as f:
-        workshop_tracking = json.load(f)
+    with open(WORKSHOP_TRACK_FILE, "rb") as f:
+        workshop_tracking = json_loads(f.read())
 else:
     workshop_tracking = {}
 
+# Replay sends logged since the last compaction
+processed_emails.update(read_log(PROCESSED_LOG_FILE))
+for email, date_str, hour in read_log(REMINDER_LOG_FILE):
+    reminder_sent.setdefault(email, {}).setdefault(date_str, set()).add(hour)
+
+# Unbuffered: every entry reaches the file in a single write() of its own
+processed_log = open(PROCESSED_LOG_FILE, "ab", buffering=0)
+reminder_log = open(REMINDER_LOG_FILE, "ab", buffering=0)
+
+# Set when workshop_tracking changes; commit_state() writes the file once per run
+tracking_dirty = False
+
 
 
 # Workshop constants
 WORKSHOP_TITLE = os.getenv("WORKSHOP_TITLE", "Agentic AI Workshop")
-WORKSHOP_TIMEZONE = pytz.timezone("Asia/Kolkata")
+WORKSHOP_TIMEZONE = ZoneInfo("Asia/Kolkata")
 WORKSHOP_PLATFORM_LINK = os.getenv("WORKSHOP_PLATFORM_LINK", "https://meet.google.com/xyz-abc-def")
 IMAGE_PATH = os.path.join("static", "image.jpeg")
 WORKSHOP_DAYS = {1, 4, 6}  # Tuesday=1, Friday=4, Sunday=6
+# For each weekday, the days until each workshop weekday in ascending order
+WORKSHOP_DAY_OFFSETS = [
+    tuple(sorted((workshop_day - weekday) % 7 for workshop_day in WORKSHOP_DAYS))
+    for weekday in range(7)
+]
+
+# Inline image, shown in the bodies as cid:workshop_image. It is read and
+# base64-encoded once here; render_message() splices in its flattened bytes.
+WORKSHOP_IMAGE = None
+if os.path.exists(IMAGE_PATH):
+    with open(IMAGE_PATH, "rb") as img_file:
+        WORKSHOP_IMAGE = MIMEImage(img_file.read(), _subtype="jpeg")
+    WORKSHOP_IMAGE.add_header("Content-ID", "<workshop_image>")
+    WORKSHOP_IMAGE.add_header("Content-Disposition", "inline", filename="image.jpeg")
+
+# Concurrency settings
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", 8))
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 5))  # caps concurrent sends within provider limits
+SMTP_IDLE_TIMEOUT = 60  # seconds idle before a pooled session is probed with NOOP
+SMTP_MAX_MESSAGES = int(os.getenv("SMTP_MAX_MESSAGES", 100))  # sends per session before it is cycled
+SMTP_MAX_RETRIES = 3  # retries on transient server codes
+SMTP_TRANSIENT_CODES = {421, 450, 454}
+
+# Reminders are personalised by default; turn off to send each slot as Bcc batches
+PERSONALIZED_REMINDERS = os.getenv("PERSONALIZED_REMINDERS", "true").lower() != "false"
+BCC_BATCH_SIZE = int(os.getenv("BCC_BATCH_SIZE", 50))  # recipients per batched message
+
+# Guards the tracking dicts/sets and their files across worker threads
+state_lock = threading.Lock()
+
+# =======================
+# EMAIL TEMPLATES
+# =======================
+def prebind_template(text, **constants):
+    """Fill in run-invariant fields now, leaving per-recipient $placeholders."""
+    escaped = {key: str(value).replace("$", "$$") for key, value in constants.items()}
+    return Template(Template(text).safe_substitute(escaped))
+
+HTML_GAP_RE = re.compile(r">\s+<")
+WHITESPACE_RE = re.compile(r"\s+")
+
+def minify_html(markup):
+    """Drop the source indentation between tags and collapse the rest to single
+    spaces (how HTML renders it anyway); placeholders are left untouched."""
+    return WHITESPACE_RE.sub(" ", HTML_GAP_RE.sub("><", markup.strip()))
+
+CONFIRMATION_SUBJECT = prebind_template(
+    "🎉 Congratulations $name! Your $title Workshop Registration is Confirmed",
+    title=WORKSHOP_TITLE,
+)
+
+# Bodies are bound and cached by get_workshop_schedule() and
+# get_reminder_template(); rows only fill in $name
+CONFIRMATION_HTML = minify_html("""
+<html><body>
+    <h2>Registration Confirmed</h2>
+    <p>Dear <b>$name</b>,</p>
+    <p>You are confirmed for the <b>$title</b> workshop.</p>
+    <p>Here are the upcoming workshop dates you can join on any of these as per your convenience:</p>
+    $workshops_html
+    <p>Click on the Gmeet link provided below to attend the workshop:</p>
+    <p>
+        🔗<a href="$link" style="font-size: 20px; font-weight: bold; color: #007BFF; text-decoration: none;"> Join Here </a>
+    </p>
+    <img src="cid:workshop_image" alt="Workshop Image" style="max-width:500px; height:auto;">
+    <p>Feel free to discuss in case of any concern or doubts.</p>
+    <p>Thanks And Regards,</p>
+    <p>Career Lab Consulting Pvt. Ltd,</p>
+    <p>Training Manager</p>
+    <p><a href="https://wa.me/918700236923" target="_blank">
+        <img src="https://upload.wikimedia.org/wikipedia/commons/6/6b/WhatsApp.svg" alt="WhatsApp" style="width:15px; height:10px;">
+        : +91 8700 2369 23</a>
+    </p>
+</body></html>
+""")
+
+REMINDER_HTML = minify_html("""
+<html><body>
+    <h2>Workshop Reminder</h2>
+    <p>Dear <b>$name</b>,</p>
+    <p>$intro_line</p>
+    <p>$date ($weekday)<br>
+    🕗 8:00 PM - 10:00 PM IST</p>
+    <p>Click on the Gmeet link below to attend:</p>
+    🔗 <a href="$link" style="font-size: 20px; font-weight: bold;">Join Here</a>
+    <img src="cid:workshop_image" style="max-width:500px; height:auto;">
+    <p>Thanks And Regards,<br>Career Lab Consulting Pvt. Ltd,<br>Training Manager</p>
+    <p><a href="https://wa.me/918700236923" target="_blank">
+    <img src="https://upload.wikimedia.org/wikipedia/commons/6/6b/WhatsApp.svg" alt="WhatsApp" style="width:15px; height:10px;">
+    : +91 8700 2369 23</a>
+     </p>
+</body></html>
+""")
+
+# Reminders: 10 AM, 7 PM, 8 PM, each sent within ±REMINDER_TOLERANCE of the hour
+REMINDER_TOLERANCE = 10 * 60  # seconds
+REMINDER_SLOTS = [
+    (10, f"📅 Reminder: {WORKSHOP_TITLE} Workshop Starts Tonight!", "Your workshop is scheduled for tonight."),
+    (19, f"⏰ Reminder: {WORKSHOP_TITLE} Workshop Starts in 1 Hour!", "Your workshop starts in 1 hour!"),
+    (20, f"🚀 {WORKSHOP_TITLE} Workshop is Starting Now!", "The workshop is starting now — click below to join."),
+]
+
+# Loose syntax check for sheet entries: one @, no spaces, a dot in the domain
+EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+# Cached rows are the sheet's name (B) and email (C) columns
+get_name_email = operator.itemgetter(0, 1)
 
 # =======================
 # HELPER FUNCTIONS
 # =======================
+def write_json_file(data, filename):
+    """Serialize in one go, write it to a temp file, fsync and atomically swap it in."""
+    payload = json_dumps(data)
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb", buffering=65536) as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
 def save_set_to_file(data_set, filename):
-    with open(filename, "w") as f:
-        json.dump(list(data_set), f)
+    write_json_file(list(data_set), filename)
 
 def save_dict_to_file(data_dict, filename):
-    with open(filename, "w") as f:
-        json.dump(data_dict, f)
+    write_json_file(data_dict, filename)
+
+def save_reminders_to_file(reminders, filename):
+    write_json_file(
+        {email: {date_str: sorted(hours) for date_str, hours in slots.items()}
+         for email, slots in reminders.items()},
+        filename,
+    )
+
+def append_to_log(log_file, entry):
+    log_file.write(json_dumps_line(entry))
+
+def commit_state():
+    """Persist this run's changes: write workshop_tracking if it changed, then
+    fold the delta logs into the canonical JSON files and truncate them."""
+    global tracking_dirty
+    with state_lock:
+        if tracking_dirty:
+            save_dict_to_file(workshop_tracking, WORKSHOP_TRACK_FILE)
+            tracking_dirty = False
+        if processed_log.tell() or reminder_log.tell():
+            save_set_to_file(processed_emails, PROCESSED_EMAILS_FILE)
+            save_reminders_to_file(reminder_sent, REMINDER_SENT_FILE)
+            for log_file in (processed_log, reminder_log):
+                log_file.truncate(0)
+                log_file.seek(0)  # so tell() reports only entries written since
+
+atexit.register(commit_state)
+
+
+def fetch_registration_rows(skip_ttl=False):
+    """Return the name/email rows, kept in an on-disk cache.
+
+    Within SHEET_CACHE_TTL the cache is used as-is unless `skip_ttl` is set
+    (e.g. Drive just told us the sheet changed). After that a cheap Drive
+    modifiedTime probe decides whether the sheet changed at all, and if it
+    did the whole B:C range is read again (rows can be edited, sorted or
+    deleted, so appended rows alone can't be trusted).
+    """
+    cache, cache_age = None, None
+    try:
+        with open(SHEET_CACHE_FILE, "rb") as f:
+            cache = json_loads(f.read())
+        cache_age = time.time() - os.path.getmtime(SHEET_CACHE_FILE)
+    except (OSError, ValueError):
+        pass  # missing or unreadable cache → start from scratch
+
+    if not isinstance(cache, dict):
+        cache = {"modified": None, "rows": []}
+    elif not skip_ttl and cache_age < SHEET_CACHE_TTL:
+        return cache["rows"]
+
+    sheets_http = get_sheets_http()
+    modified = sheets_http.get_file_drive_metadata(SHEET_ID)["modifiedTime"]
+    if modified != cache["modified"]:
+        # Only the name (B) and email (C) columns are used; row 1 is the header
+        # Ranges are read through values.batchGet on the spreadsheet: no extra
+        # worksheet-metadata round trip, and further ranges can share the call
+        value_ranges = sheets_http.values_batch_get(
+            SHEET_ID, [absolute_range_name(SHEET_NAME, "B2:C")]
+        )["valueRanges"]
+        cache["rows"] = value_ranges[0].get("values", [])
+        cache["modified"] = modified
+    write_json_file(cache, SHEET_CACHE_FILE)  # also restarts the TTL clock
+    return cache["rows"]
 
 def get_next_workshop_datetimes(from_dt=None, count=3):
     """Return the next 'count' workshop datetimes."""
@@ -85,186 +385,527 @@ def get_next_workshop_datetimes(from_dt=None, count=3):
     else:
         from_dt = from_dt.astimezone(WORKSHOP_TIMEZONE)
 
-    next_workshops = []
-    day_offset = 0
-    while len(next_workshops) < count:
-        candidate_day = from_dt + timedelta(days=day_offset)
-        if candidate_day.weekday() in WORKSHOP_DAYS:
-            workshop_start = candidate_day.replace(hour=20, minute=0, second=0, microsecond=0)
-            if workshop_start > from_dt:
-                next_workshops.append(workshop_start)
-        day_offset += 1
-    return next_workshops
-
-def send_email(recipient, subject, html_content):
+    # Day offsets of the coming week's sessions, from the lookup table; if
+    # tonight's session has already started it moves to the end of the week
+    today = from_dt.date()
+    tonight = datetime(today.year, today.month, today.day, 20, tzinfo=WORKSHOP_TIMEZONE)
+    offsets = WORKSHOP_DAY_OFFSETS[today.weekday()]
+    if offsets[0] == 0 and tonight <= from_dt:
+        offsets = offsets[1:] + (7,)
+
+    # Later sessions repeat the same weekdays one week further out each lap
+    per_week = len(offsets)
+    return [tonight + timedelta(days=offsets[i % per_week] + 7 * (i // per_week)) for i in range(count)]
+
+def connect_smtp():
+    """Open an authenticated SMTP session to be shared across recipients."""
+    server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT)
+    server.login(SENDER_EMAIL, SENDER_PASSWORD)
+    return server
+
+def reconnect_smtp(server):
+    """Re-open a dropped SMTP session in place and log in again."""
+    server.connect(SMTP_SERVER, SMTP_PORT)
+    server.ehlo()
+    server.login(SENDER_EMAIL, SENDER_PASSWORD)
+
+def smtp_alive(server):
+    """Cheap NOOP probe of a session the server may have dropped while idle."""
     try:
+        return server.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+def open_smtp_pool(size=SMTP_POOL_SIZE):
+    """Build a queue of pre-authenticated SMTP sessions shared by worker threads.
+    The TLS handshakes and logins are network-bound, so they run side by side.
+    Sessions that fail to open are left out; only if none open is the error raised."""
+    pool = queue.Queue()
+    with ThreadPoolExecutor(max_workers=size) as executor:
+        futures = [executor.submit(connect_smtp) for _ in range(size)]
+    errors = []
+    for future in futures:
+        try:
+            pool.put((future.result(), time.monotonic(), 0))
+        except Exception as e:
+            errors.append(e)
+    if pool.empty():
+        raise errors[0]
+    if errors:
+        logger.warning("⚠️ Opened %d of %d SMTP sessions: %s", pool.qsize(), size, errors[0])
+    return pool
+
+@contextmanager
+def claim_smtp(pool):
+    """Borrow a session from the pool, cycling it first if it has already carried
+    SMTP_MAX_MESSAGES sends, or if it sat idle too long and fails a NOOP."""
+    server, last_used, sent_count = pool.get()
+    try:
+        if sent_count >= SMTP_MAX_MESSAGES or (
+            time.monotonic() - last_used > SMTP_IDLE_TIMEOUT and not smtp_alive(server)
+        ):
+            server.close()
+            sent_count = 0
+            try:
+                reconnect_smtp(server)
+            except (smtplib.SMTPException, OSError):
+                pass  # send_email retries the connection on first use
+        yield server
+    finally:
+        pool.put((server, time.monotonic(), sent_count + 1))
+
+def close_smtp_pool(pool):
+    while not pool.empty():
+        server, _, _ = pool.get_nowait()
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+def build_message(recipient, subject, html_content):
+    # There is no plain-text alternative, so the HTML part is the message body
+    # itself, or the root of the related part that carries the inline image.
+    html_part = MIMEText(html_content, "html")
+    if WORKSHOP_IMAGE_BYTES is None:
+        msg = html_part
+    else:
         msg = MIMEMultipart("related")
-        msg["Subject"] = subject
-        msg["From"] = f"Workshop Team Career Lab Consulting <{SENDER_EMAIL}>"
-        msg["To"] = recipient
-
-        msg_alternative = MIMEMultipart("alternative")
-        msg.attach(msg_alternative)
-        msg_alternative.attach(MIMEText(html_content, "html"))
-
-        if os.path.exists(IMAGE_PATH):
-            with open(IMAGE_PATH, "rb") as img_file:
-                img = MIMEImage(img_file.read())
-                img.add_header("Content-ID", "<workshop_image>")
-                img.add_header("Content-Disposition", "inline", filename="image.jpeg")
-                msg.attach(img)
-
-        with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT) as server:
-            server.login(SENDER_EMAIL, SENDER_PASSWORD)
-            server.send_message(msg)
-
-        print(f"✅ Email sent to {recipient} with subject: {subject}")
+        msg.attach(html_part)
+        msg.attach(IMAGE_STUB)
+    msg["Subject"] = subject
+    msg["From"] = SENDER_HEADER
+    msg["To"] = recipient
+    return msg
+
+def flatten_message(msg):
+    """Serialize a message to wire-format (CRLF) bytes, as send_message() would."""
+    buffer = io.BytesIO()
+    BytesGenerator(buffer).flatten(msg, linesep="\r\n")
+    return buffer.getvalue()
+
+# The image part is flattened once. Messages are built with a tiny stub part
+# in its place and the stub's bytes are swapped for the image's afterwards, so
+# the base64 blob is never re-serialized per recipient.
+IMAGE_STUB = MIMEText("workshop-image-stub")
+IMAGE_STUB_BYTES = flatten_message(IMAGE_STUB)
+WORKSHOP_IMAGE_BYTES = flatten_message(WORKSHOP_IMAGE) if WORKSHOP_IMAGE is not None else None
+del WORKSHOP_IMAGE  # only the flattened bytes are used from here on
+
+def render_message(recipient, subject, html_content):
+    msg_bytes = flatten_message(build_message(recipient, subject, html_content))
+    if WORKSHOP_IMAGE_BYTES is not None:
+        msg_bytes = msg_bytes.replace(IMAGE_STUB_BYTES, WORKSHOP_IMAGE_BYTES, 1)
+    return msg_bytes
+
+def deliver(server, recipients, msg_bytes):
+    """sendmail() with one reconnect on a dropped session and jittered
+    exponential backoff on transient server codes. Permanent failures raise."""
+    reconnected = False
+    for attempt in range(SMTP_MAX_RETRIES + 1):
+        try:
+            return server.sendmail(SENDER_EMAIL, recipients, msg_bytes)
+        except smtplib.SMTPServerDisconnected:
+            if reconnected or attempt == SMTP_MAX_RETRIES:
+                raise
+            reconnect_smtp(server)
+            reconnected = True
+            continue
+        except smtplib.SMTPRecipientsRefused as e:
+            # Every recipient refused; worth retrying only if none of it is permanent
+            if attempt == SMTP_MAX_RETRIES or not all(
+                code in SMTP_TRANSIENT_CODES for code, _ in e.recipients.values()
+            ):
+                raise
+        except smtplib.SMTPResponseException as e:
+            if e.smtp_code not in SMTP_TRANSIENT_CODES or attempt == SMTP_MAX_RETRIES:
+                raise
+        time.sleep(min(2 ** attempt, 30) + random.random())
+
+def send_email(server, recipient, subject, html_content):
+    try:
+        msg_bytes = render_message(recipient, subject, html_content)
+        deliver(server, [recipient], msg_bytes)
+
+        logger.info("✅ Email sent to %s with subject: %s", recipient, subject)
         return True
     except Exception as e:
-        print(f"❌ Error sending to {recipient}: {e}")
+        logger.error("❌ Error sending to %s: %s", recipient, e)
         return False
 
+def send_bulk_email(server, recipients, subject, html_content):
+    """Send one message to many Bcc recipients and return the ones accepted."""
+    try:
+        msg_bytes = render_message(SENDER_EMAIL, subject, html_content)
+        refused = deliver(server, recipients, msg_bytes)
+
+        accepted = [recipient for recipient in recipients if recipient not in refused]
+        logger.info("✅ Email sent to %d recipients with subject: %s", len(accepted), subject)
+        return accepted
+    except Exception as e:
+        logger.error("❌ Error sending to %d recipients: %s", len(recipients), e)
+        return []
+
+@lru_cache(maxsize=16)
+def get_day_labels(day):
+    """Return the tracking key, long date and weekday name for a date."""
+    return day.isoformat(), day.strftime("%B %d, %Y"), day.strftime("%A")
+
 # Helper to format multiple upcoming workshops as HTML
 def format_workshop_schedule(workshop_dates):
     schedule_html = "<ul>"
     for dt in workshop_dates:
-        schedule_html += f"<li> {dt.strftime('%B %d, %Y')} ({dt.strftime('%A')}) 🕗 8:00 PM - 10:00 PM IST</li>"
+        _, long_date, weekday = get_day_labels(dt.date())
+        schedule_html += f"<li> {long_date} ({weekday}) 🕗 8:00 PM - 10:00 PM IST</li>"
     schedule_html += "</ul>"
     return schedule_html
 
 
-def is_within_tolerance(now, target_hour, minutes_tolerance=10):
-    """Check if current time is within ±minutes_tolerance of target_hour IST."""
-    target_time = now.replace(hour=target_hour, minute=0, second=0, microsecond=0)
-    diff = abs((now - target_time).total_seconds()) / 60  # difference in minutes
-    return diff <= minutes_tolerance
+@lru_cache(maxsize=8)
+def get_workshop_schedule(hour_start):
+    """Return the next three workshop date keys and the confirmation body
+    listing them, bound down to $name.
+
+    Sessions start on the hour, so the answer is the same for every moment in
+    the hour beginning at `hour_start`; keying on it lets repeated runs reuse it.
+    """
+    next_workshops = get_next_workshop_datetimes(hour_start, count=3)
+    workshop_keys = tuple(dt.date().isoformat() for dt in next_workshops)
+    confirmation_template = prebind_template(
+        CONFIRMATION_HTML, title=WORKSHOP_TITLE, link=WORKSHOP_PLATFORM_LINK,
+        workshops_html=format_workshop_schedule(next_workshops),
+    )
+    return workshop_keys, confirmation_template
+
+@lru_cache(maxsize=16)
+def get_reminder_template(day, intro_line):
+    """Return a reminder slot's body for a workshop day, bound down to $name."""
+    _, long_date, weekday = get_day_labels(day)
+    return prebind_template(
+        REMINDER_HTML, link=WORKSHOP_PLATFORM_LINK,
+        intro_line=intro_line, date=long_date, weekday=weekday,
+    )
 
 
+@lru_cache(maxsize=16)
+def get_slot_timestamps(day):
+    """Return the POSIX timestamp of each REMINDER_SLOTS hour on a date, so
+    reminder windows are checked with plain float comparisons."""
+    return tuple(
+        datetime(day.year, day.month, day.day, hour, tzinfo=WORKSHOP_TIMEZONE).timestamp()
+        for hour, _, _ in REMINDER_SLOTS
+    )
+
+
+
+def mark_tracking_dirty():
+    global tracking_dirty
+    tracking_dirty = True
+
 
 def cleanup_old_workshops():
     """Remove past workshop dates from tracking file."""
     today = datetime.now(WORKSHOP_TIMEZONE).date()
     changed = False
     for email in list(workshop_tracking.keys()):
-        future_dates = [d for d in workshop_tracking[email] if datetime.strptime(d, "%Y-%m-%d").date() >= today]
+        future_dates = [d for d in workshop_tracking[email] if date.fromisoformat(d) >= today]
         if future_dates != workshop_tracking[email]:
             workshop_tracking[email] = future_dates
             changed = True
     if changed:
-        save_dict_to_file(workshop_tracking, WORKSHOP_TRACK_FILE)
+        mark_tracking_dirty()
+
+
+def record_reminder(email, date_key, hour):
+    with state_lock:
+        reminder_sent.setdefault(email, {}).setdefault(date_key, set()).add(hour)
+        append_to_log(reminder_log, [email, date_key, hour])
+
+def refresh_tracking(email, run):
+    """Keep a registration's list of upcoming workshop dates current.
+
+    Pure bookkeeping with no sends, so main() runs it for every registration
+    before deciding whether the run has anything to send.
+    """
+    personal_workshops = workshop_tracking.setdefault(email, [])
+
+    # After workshop ends (10 PM IST), remove it from the list
+    if personal_workshops[:1] == [run["today_key"]] and run["now"].hour >= 22:
+        personal_workshops.pop(0)
+        mark_tracking_dirty()
+
+    # If user not tracked yet (or every date has passed) → assign first 3 upcoming workshops
+    if not personal_workshops:
+        personal_workshops.extend(run["workshop_keys"])
+        mark_tracking_dirty()
+
+    # If list falls below 3 dates, top it up
+    while len(personal_workshops) < 3:
+        day_after_last = date.fromisoformat(personal_workshops[-1]) + timedelta(days=1)
+        more_dates = get_next_workshop_datetimes(
+            datetime.combine(day_after_last, datetime.min.time(), tzinfo=WORKSHOP_TIMEZONE), count=1
+        )
+        personal_workshops.append(more_dates[0].date().isoformat())
+        mark_tracking_dirty()
+
+def reminder_due(email, run):
+    """True if today is the registration's next workshop and one of the run's
+    active reminder slots hasn't gone out to it yet."""
+    if workshop_tracking[email][:1] != [run["today_key"]]:
+        return False
+    sent_slots = reminder_sent.get(email, {}).get(run["today_key"], ())
+    return any(hour not in sent_slots for hour, _, _ in run["active_slots"])
+
+def process_row(smtp_pool, name, email, run):
+    """Send the confirmation and any due reminders for a single registration.
+
+    `run` holds the values main() derives from the current time once per run.
+    """
+    # Names come straight from the sheet; escape them for the HTML bodies
+    html_name = html.escape(name)
+
+    # Send initial confirmation email
+    if email not in processed_emails:
+        subject = CONFIRMATION_SUBJECT.substitute(name=name)
+        html_body = run["confirmation_template"].substitute(name=html_name)
+        with claim_smtp(smtp_pool) as server:
+            sent = send_email(server, email, subject, html_body)
+        if sent:
+            with state_lock:
+                processed_emails.add(email)
+                append_to_log(processed_log, email)
+
+    # === INTEGRATED LOGIC: Process only the first upcoming workshop ===
+    if workshop_tracking[email][:1] == [run["today_key"]]:
+        sent_slots = reminder_sent.get(email, {}).get(run["today_key"], ())
+
+        for hour, subject_prefix, reminder_template in run["active_slots"]:
+            if hour in sent_slots:
+                continue
+
+            if run["reminder_batches"] is not None:
+                # Sent once for the whole slot by send_reminder_batches()
+                with state_lock:
+                    run["reminder_batches"].setdefault(hour, []).append(email)
+            else:
+                html_body = reminder_template.substitute(name=html_name)
+                with claim_smtp(smtp_pool) as server:
+                    sent = send_email(server, email, subject_prefix, html_body)
+                if sent:
+                    record_reminder(email, run["today_key"], hour)
+
+
+def send_reminder_batches(smtp_pool, run):
+    """Send each due reminder slot once, Bcc'd to every recipient collected for it."""
+    for hour, subject_prefix, reminder_template in run["active_slots"]:
+        recipients = run["reminder_batches"].get(hour)
+        if not recipients:
+            continue
+
+        html_body = reminder_template.substitute(name="Participant")
+        # Providers cap recipients per message, so large slots go out in chunks
+        for start in range(0, len(recipients), BCC_BATCH_SIZE):
+            with claim_smtp(smtp_pool) as server:
+                accepted = send_bulk_email(
+                    server, recipients[start:start + BCC_BATCH_SIZE], subject_prefix, html_body
+                )
+            # Only recipients the server accepted are marked as reminded
+            for email in accepted:
+                record_reminder(email, run["today_key"], hour)
 
 
 # =======================
 # MAIN LOGIC
 # =======================
-def main():
-    cleanup_old_workshops()
-    now = datetime.now(WORKSHOP_TIMEZONE)
-    rows = SHEET.get_all_values()[1:]
-    next_workshops = get_next_workshop_datetimes(now, count=3)
-    workshops_html = format_workshop_schedule(next_workshops)
-
-    for row in rows:
+def main(refresh_sheet=False):
+    try:
+        cleanup_old_workshops()
+        now = datetime.now(WORKSHOP_TIMEZONE)
+        rows = fetch_registration_rows(skip_ttl=refresh_sheet)
+        workshop_keys, confirmation_template = get_workshop_schedule(now.replace(minute=0, second=0, microsecond=0))
+
+        today_key = get_day_labels(now.date())[0]
+
+        # Reminder windows depend only on `now`, so work them out once per run,
+        # each with its body already bound to everything but the name
+        active_slots = []
+        if now.weekday() in WORKSHOP_DAYS:
+            now_ts = now.timestamp()
+            active_slots = [
+                (hour, subject, get_reminder_template(now.date(), intro_line))
+                for (hour, subject, intro_line), slot_ts in zip(REMINDER_SLOTS, get_slot_timestamps(now.date()))
+                if abs(now_ts - slot_ts) <= REMINDER_TOLERANCE
+            ]
+
+        # Everything shared by all rows is formatted once here; rows only add their name
+        run = {
+            "now": now,
+            "active_slots": active_slots,
+            "workshop_keys": workshop_keys,
+            "confirmation_template": confirmation_template,
+            "today_key": today_key,
+            # {hour: [email, ...]} collected by process_row() when batching reminders
+            "reminder_batches": None if PERSONALIZED_REMINDERS else {},
+        }
+
+        # Rows are handled concurrently, so collapse duplicate registrations up
+        # front; the first row for an email wins, as it did in the serial loop.
+        # Malformed addresses are dropped here rather than rejected by the server.
+        registrations = {}
+        for row in rows:
+            try:
+                name, email = get_name_email(row)
+            except IndexError:
+                continue  # the Sheets API drops trailing empty cells
+
+            name, email = name.strip().upper(), email.strip()
+            if not email or not name or not EMAIL_RE.match(email):
+                continue
+            registrations.setdefault(email, name)
+
+        for email in registrations:
+            refresh_tracking(email, run)
+
+        # Only registrations with something to send reach the worker pool: new
+        # ones, and, inside a reminder window, those whose workshop is today and
+        # who still miss one of its reminders. Idle runs end here without
+        # opening any SMTP sessions.
+        pending = {
+            email: name for email, name in registrations.items()
+            if email not in processed_emails or reminder_due(email, run)
+        }
+        if not pending:
+            return False
+
+        # No point authenticating more sessions than there are recipients, nor
+        # running more workers than there are sessions for them to send on
+        pool_size = min(SMTP_POOL_SIZE, len(pending))
+        smtp_pool = open_smtp_pool(pool_size)
         try:
-            name = row[1].strip().upper() if len(row) > 1 else None
-            email = row[2].strip() if len(row) > 2 else None
-        except Exception:
-            continue
-
-        if not email or not name:
-            continue
-
-        # If user not tracked yet → assign first 3 upcoming workshops
-        if email not in workshop_tracking:
-            workshop_tracking[email] = [dt.strftime("%Y-%m-%d") for dt in get_next_workshop_datetimes(now, count=3)]
-            save_dict_to_file(workshop_tracking, WORKSHOP_TRACK_FILE)
-
-        # Send initial confirmation email
-        if email not in processed_emails:
-            subject = f"🎉 Congratulations {name}! Your {WORKSHOP_TITLE} Workshop Registration is Confirmed"
-            html_body = f"""
-            <html><body>
-                <h2>Registration Confirmed</h2>
-                <p>Dear <b>{name}</b>,</p>
-                <p>You are confirmed for the <b>{WORKSHOP_TITLE}</b> workshop.</p>
-                <p>Here are the upcoming workshop dates you can join on any of these as per your convenience:</p>
-                {workshops_html}
-                <p>Click on the Gmeet link provided below to attend the workshop:</p>
-                <p>
-                    🔗<a href="{WORKSHOP_PLATFORM_LINK}" style="font-size: 20px; font-weight: bold; color: #007BFF; text-decoration: none;"> Join Here </a>
-                </p>
-                <img src="cid:workshop_image" alt="Workshop Image" style="max-width:500px; height:auto;">
-                <p>Feel free to discuss in case of any concern or doubts.</p>
-                <p>Thanks And Regards,</p>
-                <p>Career Lab Consulting Pvt. Ltd,</p>
-                <p>Training Manager</p>
-                <p><a href="https://wa.me/918700236923" target="_blank">
-                    <img src="https://upload.wikimedia.org/wikipedia/commons/6/6b/WhatsApp.svg" alt="WhatsApp" style="width:15px; height:10px;">
-                    : +91 8700 2369 23</a>
-                </p>
-            </body></html>
-            """
-            if send_email(email, subject, html_body):
-                processed_emails.add(email)
-                save_set_to_file(processed_emails, PROCESSED_EMAILS_FILE)
-
-        # === INTEGRATED LOGIC: Process only the first upcoming workshop ===
-        personal_workshops = workshop_tracking.get(email, [])
-        if personal_workshops:
-            next_ws_date_str = personal_workshops[0]
-            ws_dt = datetime.strptime(next_ws_date_str, "%Y-%m-%d").replace(tzinfo=WORKSHOP_TIMEZONE)
-
-            if now.date() == ws_dt.date():
-                reminders_for_email = reminder_sent.get(email, [])
-
-                # Reminders: 10 AM, 7 PM, 8 PM
-                for hour, subject_prefix, intro_line in [
-                    (10, f"📅 Reminder: {WORKSHOP_TITLE} Workshop Starts Tonight!", "Your workshop is scheduled for tonight."),
-                    (19, f"⏰ Reminder: {WORKSHOP_TITLE} Workshop Starts in 1 Hour!", "Your workshop starts in 1 hour!"),
-                    (20, f"🚀 {WORKSHOP_TITLE} Workshop is Starting Now!", "The workshop is starting now — click below to join.")
-                ]:
-                    if is_within_tolerance(now, hour):
-                        reminder_key = f"{next_ws_date_str}_{hour}"
-                        if reminder_key not in reminders_for_email:
-                            html_body = f"""
-                            <html><body>
-                                <h2>Workshop Reminder</h2>
-                                <p>Dear <b>{name}</b>,</p>
-                                <p>{intro_line}</p>
-                                <p>{ws_dt.strftime('%B %d, %Y')} ({ws_dt.strftime('%A')})<br>
-                                🕗 8:00 PM - 10:00 PM IST</p>
-                                <p>Click on the Gmeet link below to attend:</p>
-                                🔗 <a href="{WORKSHOP_PLATFORM_LINK}" style="font-size: 20px; font-weight: bold;">Join Here</a>
-                                <img src="cid:workshop_image" style="max-width:500px; height:auto;">
-                                <p>Thanks And Regards,<br>Career Lab Consulting Pvt. Ltd,<br>Training Manager</p>
-                                <p><a href="https://wa.me/918700236923" target="_blank">
-                                <img src="https://upload.wikimedia.org/wikipedia/commons/6/6b/WhatsApp.svg" alt="WhatsApp" style="width:15px; height:10px;">
-                                : +91 8700 2369 23</a>
-                                 </p>
-                            </body></html>
-                            """
-                            if send_email(email, subject_prefix, html_body):
-                                reminders_for_email.append(reminder_key)
-                                reminder_sent[email] = reminders_for_email
-                                save_dict_to_file(reminder_sent, REMINDER_SENT_FILE)
-
-                # After workshop ends (10 PM IST), remove it from the list
-                if now.hour >= 22:
-                    workshop_tracking[email].pop(0)
-                    save_dict_to_file(workshop_tracking, WORKSHOP_TRACK_FILE)
-
-            # If list falls below 3 dates, top it up
-            while len(workshop_tracking[email]) < 3:
-                last_date = datetime.strptime(workshop_tracking[email][-1], "%Y-%m-%d")
-                more_dates = get_next_workshop_datetimes(last_date + timedelta(days=1), count=1)
-                workshop_tracking[email].append(more_dates[0].strftime("%Y-%m-%d"))
-                save_dict_to_file(workshop_tracking, WORKSHOP_TRACK_FILE)
+            with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, smtp_pool.qsize())) as executor:
+                futures = [
+                    executor.submit(process_row, smtp_pool, name, email, run)
+                    for email, name in pending.items()
+                ]
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    # e.g. SIGTERM: drop rows not started yet so only the
+                    # in-flight sends finish before state is committed
+                    executor.shutdown(cancel_futures=True)
+                    raise
+
+            if run["reminder_batches"]:
+                send_reminder_batches(smtp_pool, run)
+        finally:
+            close_smtp_pool(smtp_pool)
+
+        # Tells serve() whether a reminder in the current window still failed
+        return any(reminder_due(email, run) for email in pending)
+    finally:
+        commit_state()
 
 
-if __name__ == "__main__":
-    main()
+# =======================
+# DRIVE PUSH WEBHOOK
+# =======================
+# Subscribe this endpoint to the sheet with Drive's files.watch so new
+# registrations are confirmed as soon as they land instead of on the next
+# scheduled run. Reminders still come from the scheduled runs.
+# The endpoint is served by the `serve` process itself and only flags the
+# change; that process's loop does the run, so there is one sender and one
+# copy of the tracking state, and Drive gets its answer straight away.
+WEBHOOK_TOKEN = os.getenv("WEBHOOK_TOKEN")
+app = Flask(__name__)
+refresh_requested = threading.Event()
+
+@app.route("/drive-webhook", methods=["POST"])
+def drive_webhook():
+    # No token configured → nothing can prove the request came from our channel
+    channel_token = request.headers.get("X-Goog-Channel-Token", "")
+    if not WEBHOOK_TOKEN or not hmac.compare_digest(channel_token.encode(), WEBHOOK_TOKEN.encode()):
+        return "", 403
+    # Drive sends a "sync" message when the channel is created; nothing changed yet
+    if request.headers.get("X-Goog-Resource-State") == "sync":
+        return "", 200
+
+    refresh_requested.set()
+    return "", 200
 
 
+# =======================
+# SCHEDULED LOOP
+# =======================
+# `python index.py serve` keeps one process alive and sleeps until the next
+# reminder slot or the next routine pass for new registrations, instead of
+# being started on a fixed short interval. A slot whose run left reminders
+# unsent gets a retry pass while its window is still open.
+RUN_INTERVAL = int(os.getenv("RUN_INTERVAL", 900))  # seconds between routine passes
+
+def next_wakeup(now, retry=False):
+    """Return the timestamp of the next reminder slot, or of the next routine
+    pass if that comes first. With `retry` (the last run left reminders
+    unsent) a slot's retry pass counts too."""
+    now_ts = now.timestamp()
+    wakeup = now_ts + RUN_INTERVAL
+    for days_ahead in range(8):
+        day = now.date() + timedelta(days=days_ahead)
+        if day.weekday() not in WORKSHOP_DAYS:
+            continue
+        for slot_ts in get_slot_timestamps(day):
+            for pass_ts in (slot_ts, slot_ts + REMINDER_TOLERANCE // 2)[:2 if retry else 1]:
+                if now_ts < pass_ts < wakeup:
+                    return pass_ts
+    return wakeup
+
+def serve():
+    def wait(timeout):
+        # Sleep like time.sleep, but wake early when the webhook flags a change
+        if refresh_requested.wait(timeout):
+            refresh_requested.clear()
+            scheduler.enter(0, 0, run, kwargs={"refresh_sheet": True})
+
+    scheduler = sched.scheduler(time.time, wait)
+
+    def run(refresh_sheet=False):
+        # A failed run (sheet or SMTP outage) must not end the loop; it may
+        # have missed reminders, so it asks for a retry pass like a partial one
+        try:
+            return main(refresh_sheet=refresh_sheet)
+        except Exception:
+            logger.exception("❌ Run failed")
+            return True
 
+    def tick():
+        retry = True
+        try:
+            retry = run()
+        finally:
+            scheduler.enterabs(next_wakeup(datetime.now(WORKSHOP_TIMEZONE), retry), 1, tick)
+
+    # Flask only answers the webhook; every run happens on this thread. Its
+    # built-in threaded server is used on purpose: the endpoint takes a few
+    # authenticated Drive notifications an hour and returns at once, and a
+    # forking WSGI server would put the webhook in another process than the
+    # state it has to reach.
+    threading.Thread(
+        target=app.run,
+        kwargs={"host": "0.0.0.0", "port": int(os.getenv("PORT", 5000))},
+        daemon=True,
+    ).start()
+    scheduler.enter(0, 1, tick)
+    scheduler.run()
+
+
+def handle_sigterm(signum, frame):
+    # Container stops send SIGTERM; raising SystemExit lets main()'s finally
+    # block and the atexit hook persist state instead of dying mid-run.
+    raise SystemExit(128 + signum)
 
 
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    if sys.argv[1:] == ["serve"]:
+        serve()
+    else:
+        main()